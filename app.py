@@ -1,11 +1,17 @@
 import streamlit as st
 import pandas as pd
+import asyncio
+import hashlib
 import os
+import threading
+from collections import OrderedDict
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import PydanticOutputParser
 from typing import List
 from pydantic import BaseModel
 from insight_extractor import InsightExtractor, Treatment, PatientInsights
+from secrets_manager import warm_cache
+from highlighter import highlight_text
 from dotenv import load_dotenv
 
 class TreatmentList(BaseModel):
@@ -14,6 +20,14 @@ class TreatmentList(BaseModel):
 # Chargement des variables d'environnement
 load_dotenv()
 
+# Résolution groupée des secrets SSM une seule fois par processus, et non à chaque rerun :
+# un paramètre introuvable ne relance pas d'appel SSM à chaque interaction
+@st.cache_resource
+def _warm_secrets():
+    warm_cache(["OPENAI_API_KEY", "MISTRAL_API_KEY"])
+
+_warm_secrets()
+
 st.set_page_config(page_title="Patient Insight Extractor", layout="wide")
 
 # Initialisation du session_state
@@ -30,39 +44,15 @@ def reset_state():
     st.session_state.patient_text = ""
     st.rerun()
 
-def highlight_text(text, insights):
-    """Simple HTML highlighter for medical terms and medications"""
-    import re
-    if not insights:
-        return text
-    
-    terms_to_highlight = set()
-    
-    # Collect medications
-    for t in (insights.traitements_habituels or []):
-        terms_to_highlight.add(t.name)
-    for t in (insights.traitement_sortie or []):
-        terms_to_highlight.add(t.name)
-    
-    # Collect other terms (simple split)
-    for ant in (insights.antecedents_medicaux or []):
-        # Add the whole antecedent and also individual words if they look like medical terms
-        terms_to_highlight.add(ant)
-    
-    if insights.raison_hospitalisation:
-        terms_to_highlight.add(insights.raison_hospitalisation)
-
-    # Sort terms by length descending to avoid partial matches inside larger matches
-    sorted_terms = sorted([t for t in terms_to_highlight if t and len(t) > 2], key=len, reverse=True)
-    
-    highlighted = text.replace("\n", "<br>")
-    
-    for term in sorted_terms:
-        # Case insensitive replacement with highlight
-        pattern = re.compile(re.escape(term), re.IGNORECASE)
-        highlighted = pattern.sub(r'<span style="background-color: #ffff00; color: black; font-weight: bold;">\g<0></span>', highlighted)
-        
-    return highlighted
+def treatments_dataframe(treatments):
+    """Build the treatments table column by column, with a Vidal search link per medication"""
+    df = pd.DataFrame({
+        "Médicament": [t.name for t in treatments],
+        "Dosage": [t.dosage for t in treatments],
+        "Fréquence": [t.frequency for t in treatments],
+    })
+    df["Lien Vidal"] = "https://www.vidal.fr/recherche.html?query=" + df["Médicament"]
+    return df
 
 # Layout de l'en-tête
 col_title, col_reset = st.columns([4, 1])
@@ -86,6 +76,44 @@ model_name = st.sidebar.text_input("Modèle", value=os.getenv("MODEL_NAME", "gpt
 def get_extractor(provider, name):
     return InsightExtractor(model_provider=provider, model_name=name)
 
+# Au-delà, les extractions les moins récemment utilisées sont oubliées
+EXTRACTION_CACHE_MAX_ENTRIES = 32
+
+@st.cache_resource
+def _extraction_cache():
+    # Extractions mémorisées par (provider, modèle, sha256 du texte) pour ne pas rappeler le LLM sur un texte identique,
+    # de la moins à la plus récemment utilisée ; partagées entre sessions, d'où le verrou
+    return OrderedDict(), threading.Lock()
+
+async def stream_extract(extractor, text, placeholder):
+    """Render partial insights while the model decodes, then validate the final object once"""
+    partial = {}
+    async for partial in extractor.astream_from_text(text):
+        placeholder.json(partial)
+    return PatientInsights.model_validate(partial)
+
+def extract_insights(provider, name, text):
+    key = (provider, name, hashlib.sha256(text.encode("utf-8")).hexdigest())
+    cache, lock = _extraction_cache()
+    with lock:
+        insights = cache.get(key)
+        if insights is not None:
+            cache.move_to_end(key)
+    if insights is None:
+        placeholder = st.empty()
+        try:
+            insights = asyncio.run(stream_extract(get_extractor(provider, name), text, placeholder))
+        finally:
+            # Partial JSON must not stay on screen when the extraction fails
+            placeholder.empty()
+        with lock:
+            cache[key] = insights
+            cache.move_to_end(key)
+            while len(cache) > EXTRACTION_CACHE_MAX_ENTRIES:
+                cache.popitem(last=False)
+    # Each session gets its own copy, so edits never leak into the cache or other sessions
+    return insights.model_copy(deep=True)
+
 extractor = get_extractor(model_provider, model_name)
 
 # --- LOGIQUE D'AFFICHAGE ---
@@ -102,7 +130,7 @@ if st.session_state.insights is None:
         else:
             with st.spinner("Analyse du texte par l'IA en cours..."):
                 try:
-                    res_insights = extractor.extract_from_text(patient_input)
+                    res_insights = extract_insights(model_provider, model_name, patient_input)
                     st.session_state.insights = res_insights
                     st.session_state.patient_text = patient_input
                     st.rerun()
@@ -155,24 +183,28 @@ else:
                     ("user", "{text}")
                 ])
                 try:
-                    structured_llm = extractor.llm.with_structured_output(TreatmentList)
-                    chain = prompt | structured_llm
-                    res = chain.invoke({"text": new_presc_input, "format_instructions": parser.get_format_instructions()})
-                    new_treatments = res.treatments
-                except:
-                    chain = prompt | extractor.llm | parser
-                    res = chain.invoke({"text": new_presc_input, "format_instructions": parser.get_format_instructions()})
-                    new_treatments = res.treatments
+                    try:
+                        structured_llm = extractor.llm.with_structured_output(TreatmentList)
+                        chain = prompt | structured_llm
+                        res = chain.invoke({"text": new_presc_input, "format_instructions": parser.get_format_instructions()})
+                        new_treatments = res.treatments
+                    except (NotImplementedError, AttributeError):
+                        chain = prompt | extractor.llm | parser
+                        res = chain.invoke({"text": new_presc_input, "format_instructions": parser.get_format_instructions()})
+                        new_treatments = res.treatments
 
-                st.session_state.comparison = extractor.compare_prescription(insights, new_treatments)
+                    st.session_state.comparison = extractor.compare_prescription(insights, new_treatments)
+                except Exception as e:
+                    st.error(f"Une erreur est survenue : {e}")
 
     if st.session_state.comparison:
         comp = st.session_state.comparison
         st.markdown("#### Résultats de la comparaison")
-        df_comp = pd.DataFrame([
-            {"Médicament": c.medication_name, "Statut": c.status, "Détails": c.details} 
-            for c in comp.comparisons
-        ])
+        df_comp = pd.DataFrame.from_records(
+            ((c.medication_name, c.status, c.details) for c in comp.comparisons),
+            columns=["Médicament", "Statut", "Détails"]
+        )
+        df_comp["Statut"] = df_comp["Statut"].astype("category")
         st.table(df_comp)
         
         st.markdown("#### Recommandations")
@@ -182,14 +214,7 @@ else:
     st.markdown("---")
     st.markdown("### 💊 Traitements Habituels")
     if insights.traitements_habituels:
-        data_hab = []
-        for t in insights.traitements_habituels:
-            row = t.model_dump()
-            row["Vidal"] = f"https://www.vidal.fr/recherche.html?query={t.name}"
-            data_hab.append(row)
-        
-        df_hab = pd.DataFrame(data_hab)
-        df_hab.columns = ["Médicament", "Dosage", "Fréquence", "Lien Vidal"]
+        df_hab = treatments_dataframe(insights.traitements_habituels)
         st.dataframe(
             df_hab,
             column_config={
@@ -208,14 +233,7 @@ else:
 
     st.markdown("### 📋 Traitement de Sortie")
     if insights.traitement_sortie:
-        data_sortie = []
-        for t in insights.traitement_sortie:
-            row = t.model_dump()
-            row["Vidal"] = f"https://www.vidal.fr/recherche.html?query={t.name}"
-            data_sortie.append(row)
-            
-        df_sortie = pd.DataFrame(data_sortie)
-        df_sortie.columns = ["Médicament", "Dosage", "Fréquence", "Lien Vidal"]
+        df_sortie = treatments_dataframe(insights.traitement_sortie)
         st.dataframe(
             df_sortie,
             column_config={
@@ -0,0 +1,13 @@
+"""
+Shared pytest configuration for the mock tests
+"""
+
+import pytest
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _openai_env():
+    """Install a fake OpenAI API key once for the whole test session"""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("OPENAI_API_KEY", "fake-test-key")
+        yield
@@ -0,0 +1,96 @@
+"""
+HTML highlighter for medical terms and medications found in a patient report
+
+Kept outside the Streamlit script so it can be imported (and tested) on its own.
+"""
+
+import re
+from functools import lru_cache
+
+# Au-delà, seul le début du texte est surligné pour ne pas figer l'interface
+HIGHLIGHT_MAX_CHARS = 30_000
+
+
+def _trie_pattern(root):
+    """
+    Turn a character trie into a regex where each position only explores the branches of the current prefix.
+    Built bottom-up with an explicit stack, so long terms do not hit the recursion limit.
+    """
+    patterns = {}
+    stack = [(root, False)]
+    while stack:
+        node, children_done = stack.pop()
+        children = [(char, child) for char, child in sorted(node.items()) if char]
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((child, False) for _, child in children)
+            continue
+        branches = [re.escape(char) + patterns.pop(id(child)) for char, child in children]
+        if not branches:
+            patterns[id(node)] = ""
+            continue
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # "" marks the end of a term: the rest is optional, and greedy so the longest term wins
+        patterns[id(node)] = f"(?:{body})?" if "" in node else body
+    return patterns[id(root)]
+
+
+@lru_cache(maxsize=128)
+def _compile_highlighter(terms):
+    """
+    Compile the case-insensitive pattern matching any of the given terms.
+    Terms are matched through a trie-shaped regex, so the longest term wins.
+    Cached per process so Streamlit reruns with the same insights reuse the compiled pattern.
+    """
+    trie = {}
+    for term in terms:
+        node = trie
+        for char in term.lower():
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return re.compile(_trie_pattern(trie), re.IGNORECASE)
+
+
+def highlight_text(text, insights):
+    """Simple HTML highlighter for medical terms and medications"""
+    if not insights:
+        return text
+
+    if len(text) > HIGHLIGHT_MAX_CHARS:
+        # Highlight the beginning only and append the tail verbatim
+        return highlight_text(text[:HIGHLIGHT_MAX_CHARS], insights) + text[HIGHLIGHT_MAX_CHARS:].replace("\n", "<br>")
+
+    terms_to_highlight = set()
+
+    # Collect medications
+    for t in (insights.traitements_habituels or []):
+        terms_to_highlight.add(t.name)
+    for t in (insights.traitement_sortie or []):
+        terms_to_highlight.add(t.name)
+
+    # Collect other terms (simple split)
+    for ant in (insights.antecedents_medicaux or []):
+        # Add the whole antecedent and also individual words if they look like medical terms
+        terms_to_highlight.add(ant)
+
+    if insights.raison_hospitalisation:
+        terms_to_highlight.add(insights.raison_hospitalisation)
+
+    # Sorted only to get a stable cache key: the trie pattern already prefers the longest match
+    sorted_terms = sorted(t for t in terms_to_highlight if t and len(t) > 2)
+
+    if not sorted_terms:
+        return text.replace("\n", "<br>")
+
+    # Single pass over the plain text: slices between matches are copied with line breaks converted
+    # and terms are wrapped, so the output is never scanned again
+    pattern = _compile_highlighter(tuple(sorted_terms))
+    parts = []
+    prev = 0
+    for m in pattern.finditer(text):
+        parts.append(text[prev:m.start()].replace("\n", "<br>"))
+        parts.append(f'<span style="background-color: #ffff00; color: black; font-weight: bold;">{m.group(0)}</span>')
+        prev = m.end()
+    parts.append(text[prev:].replace("\n", "<br>"))
+
+    return "".join(parts)
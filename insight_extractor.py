@@ -11,9 +11,9 @@ warnings.filterwarnings("ignore", category=UserWarning, message=".*Pydantic V1.*
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_community.chat_models import ChatOllama
-from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.output_parsers import JsonOutputParser
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional, Tuple
 from enum import Enum
 
 load_dotenv()
@@ -50,6 +50,9 @@ class PatientInsights(BaseModel):
         for treatment in self.traitement_sortie:
             treatment.name = treatment.name.upper()
 
+class PatientInsightsBatch(BaseModel):
+    items: List[PatientInsights] = Field(..., description="Un PatientInsights par compte-rendu, dans l'ordre des index")
+
 class ComparisonResult(BaseModel):
     medication_name: str
     status: str = Field(..., description="Status: 'Nouveau', 'Changé', 'Identique', 'Arrêté'")
@@ -59,7 +62,59 @@ class PrescriptionComparison(BaseModel):
     comparisons: List[ComparisonResult]
     recommendations: List[str]
 
+# Prompts partagés par tous les appels : le message système ne contient aucune variable
+# afin que le préfixe soit identique d'une requête à l'autre (cache de préfixe côté provider)
+_EXTRACT_SYSTEM = "Tu es un assistant médical expert en extraction de données structurées à partir de comptes-rendus d'hospitalisation en français."
+_EXTRACT_FALLBACK_SYSTEM = (
+    _EXTRACT_SYSTEM + "\n"
+    "Les listes de traitements doivent être ordonnées par ordre alphabétique (insensible à la casse) et le nom des médicaments doit être en MAJUSCULES."
+)
+_EXTRACT_USER = "Extrait les informations structurées du texte suivant :\n\n{text}"
+_EXTRACT_BATCH_USER = (
+    "Voici {count} comptes-rendus numérotés de [1] à [{count}]. Extrait les informations structurées de chacun "
+    "et renvoie exactement un élément par compte-rendu, dans l'ordre des index :\n\n{texts}"
+)
+_COMPARE_SYSTEM = "Tu es un expert en pharmacologie. Compare la nouvelle prescription avec les traitements habituels du patient."
+_COMPARE_USER = (
+    "Traitements habituels :\n{existing_treatments}\n\nNouvelle prescription :\n{new_prescription}\n\n"
+    "Analyse les différences (nouveaux, arrêtés, modifiés) et donne des recommandations si nécessaire."
+)
+
+_EXTRACT_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", _EXTRACT_SYSTEM),
+    ("user", _EXTRACT_USER)
+])
+_EXTRACT_FALLBACK_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", _EXTRACT_FALLBACK_SYSTEM),
+    ("user", "{format_instructions}\n\n" + _EXTRACT_USER)
+])
+_EXTRACT_BATCH_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", _EXTRACT_SYSTEM),
+    ("user", _EXTRACT_BATCH_USER)
+])
+_EXTRACT_BATCH_FALLBACK_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", _EXTRACT_FALLBACK_SYSTEM),
+    ("user", "{format_instructions}\n\n" + _EXTRACT_BATCH_USER)
+])
+_COMPARE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", _COMPARE_SYSTEM),
+    ("user", _COMPARE_USER)
+])
+_COMPARE_FALLBACK_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", _COMPARE_SYSTEM),
+    ("user", "{format_instructions}\n\n" + _COMPARE_USER)
+])
+
 class InsightExtractor:
+    # Parsers JSON et instructions de format pour le fallback, rendus une seule fois.
+    # Les parsers renvoient des dicts : la validation Pydantic n'a lieu qu'une fois, en fin de chaîne
+    _insights_parser = JsonOutputParser(pydantic_object=PatientInsights)
+    _insights_format_instructions = _insights_parser.get_format_instructions()
+    _batch_parser = JsonOutputParser(pydantic_object=PatientInsightsBatch)
+    _batch_format_instructions = _batch_parser.get_format_instructions()
+    _comparison_parser = JsonOutputParser(pydantic_object=PrescriptionComparison)
+    _comparison_format_instructions = _comparison_parser.get_format_instructions()
+
     def __init__(self, model_provider: str = "openai", model_name: Optional[str] = None, api_key: Optional[str] = None, base_url: Optional[str] = None):
         """
         Initialize the extractor with a specific provider and model.
@@ -92,58 +147,123 @@ class InsightExtractor:
         else:
             raise ValueError(f"Provider {model_provider} non supporté.")
 
-    def extract_from_text(self, text: str) -> PatientInsights:
+        # Support de with_structured_output détecté une seule fois, puis chaînes construites en conséquence
         try:
-            structured_llm = self.llm.with_structured_output(PatientInsights)
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", "Tu es un assistant médical expert en extraction de données structurées à partir de comptes-rendus d'hospitalisation en français."),
-                ("user", "Extrait les informations structurées du texte suivant :\n\n{text}")
-            ])
-            chain = prompt | structured_llm
-            return chain.invoke({"text": text})
-        except (NotImplementedError, AttributeError, Exception) as e:
+            self.llm.with_structured_output(PatientInsights)
+            self._supports_structured = True
+        except (NotImplementedError, AttributeError):
+            self._supports_structured = False
+
+        if self._supports_structured:
+            self._extract_chain = _EXTRACT_PROMPT | self.llm.with_structured_output(PatientInsights)
+            # A JSON schema dict (rather than the model) makes the structured output stream partial dicts
+            self._extract_stream_chain = _EXTRACT_PROMPT | self.llm.with_structured_output(PatientInsights.model_json_schema())
+            self._extract_batch_chain = _EXTRACT_BATCH_PROMPT | self.llm.with_structured_output(PatientInsightsBatch)
+            self._compare_chain = _COMPARE_PROMPT | self.llm.with_structured_output(PrescriptionComparison)
+        else:
             # Fallback pour les modèles ne supportant pas with_structured_output (ex: Ollama mistral)
-            parser = PydanticOutputParser(pydantic_object=PatientInsights)
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", "Tu es un assistant médical expert en extraction de données structurées à partir de comptes-rendus d'hospitalisation en français.\n"
-                           "Les listes de traitements doivent être ordonnées par ordre alphabétique (insensible à la casse) et le nom des médicaments doit être en MAJUSCULES.\n"
-                           "{format_instructions}"),
-                ("user", "Extrait les informations structurées du texte suivant :\n\n{text}")
-            ])
-            chain = prompt | self.llm | parser
-            return chain.invoke({
-                "text": text,
-                "format_instructions": parser.get_format_instructions()
-            })
+            self._extract_chain = (
+                _EXTRACT_FALLBACK_PROMPT.partial(format_instructions=self._insights_format_instructions)
+                | self.llm | self._insights_parser | PatientInsights.model_validate
+            )
+            self._extract_stream_chain = (
+                _EXTRACT_FALLBACK_PROMPT.partial(format_instructions=self._insights_format_instructions)
+                | self.llm | self._insights_parser
+            )
+            self._extract_batch_chain = (
+                _EXTRACT_BATCH_FALLBACK_PROMPT.partial(format_instructions=self._batch_format_instructions)
+                | self.llm | self._batch_parser | PatientInsightsBatch.model_validate
+            )
+            self._compare_chain = (
+                _COMPARE_FALLBACK_PROMPT.partial(format_instructions=self._comparison_format_instructions)
+                | self.llm | self._comparison_parser | PrescriptionComparison.model_validate
+            )
+
+    def extract_from_text(self, text: str) -> PatientInsights:
+        return self._extract_chain.invoke({"text": text})
+
+    async def astream_from_text(self, text: str) -> AsyncIterator[dict]:
+        """
+        Stream the extraction as progressively completed JSON objects.
+        Structured output is used when the provider supports it, the JSON prompt otherwise;
+        the caller validates the last object with PatientInsights.model_validate.
+        :param text: Patient report to process
+        """
+        async for partial in self._extract_stream_chain.astream({"text": text}):
+            yield partial
+
+    def extract_from_texts(self, texts: List[str]) -> List[PatientInsights]:
+        """
+        Extract insights from several reports in a single LLM call.
+        Reports are numbered [1]..[K] in the prompt so the instructions are sent once for the whole batch.
+        :param texts: Patient reports to process
+        :return: One PatientInsights per report, in the same order as texts
+        """
+        if not texts:
+            return []
+        inputs = {
+            "texts": "\n\n".join(f"[{i}] {text}" for i, text in enumerate(texts, start=1)),
+            "count": len(texts)
+        }
+
+        batch = self._extract_batch_chain.invoke(inputs)
+        if len(batch.items) != len(texts):
+            raise ValueError(f"Le modèle a renvoyé {len(batch.items)} résultats pour {len(texts)} comptes-rendus.")
+        return batch.items
+
+    async def aextract_from_texts(self, texts: List[str], max_concurrency: int = 8) -> List[PatientInsights]:
+        """
+        Extract insights from several reports concurrently, one request per report.
+        The requests are overlapped with abatch.
+        :param texts: Patient reports to process
+        :param max_concurrency: Maximum number of requests in flight
+        :return: One PatientInsights per report, in the same order as texts
+        """
+        return await self._extract_chain.abatch(
+            [{"text": text} for text in texts],
+            config={"max_concurrency": max_concurrency}
+        )
+
+    @staticmethod
+    def _comparison_inputs(insights: PatientInsights, new_prescription: List[Treatment]) -> dict:
+        return {
+            "existing_treatments": "\n".join([f"- {t.name} {t.dosage} {t.frequency}" for t in insights.traitements_habituels]),
+            "new_prescription": "\n".join([f"- {t.name} {t.dosage} {t.frequency}" for t in new_prescription])
+        }
 
     def compare_prescription(self, insights: PatientInsights, new_prescription: List[Treatment]) -> PrescriptionComparison:
-        existing_treatments_str = "\n".join([f"- {t.name} {t.dosage} {t.frequency}" for t in insights.traitements_habituels])
-        new_prescription_str = "\n".join([f"- {t.name} {t.dosage} {t.frequency}" for t in new_prescription])
+        return self._compare_chain.invoke(self._comparison_inputs(insights, new_prescription))
 
-        try:
-            structured_llm = self.llm.with_structured_output(PrescriptionComparison)
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", "Tu es un expert en pharmacologie. Compare la nouvelle prescription avec les traitements habituels du patient."),
-                ("user", "Traitements habituels :\n{existing_treatments}\n\nNouvelle prescription :\n{new_prescription}\n\nAnalyse les différences (nouveaux, arrêtés, modifiés) et donne des recommandations si nécessaire.")
-            ])
-            chain = prompt | structured_llm
-            return chain.invoke({
-                "existing_treatments": existing_treatments_str,
-                "new_prescription": new_prescription_str
-            })
-        except (NotImplementedError, AttributeError, Exception):
-            # Fallback
-            parser = PydanticOutputParser(pydantic_object=PrescriptionComparison)
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", "Tu es un expert en pharmacologie. Compare la nouvelle prescription avec les traitements habituels du patient.\n{format_instructions}"),
-                ("user", "Traitements habituels :\n{existing_treatments}\n\nNouvelle prescription :\n{new_prescription}\n\nAnalyse les différences (nouveaux, arrêtés, modifiés) et donne des recommandations si nécessaire.")
-            ])
-            chain = prompt | self.llm | parser
-            return chain.invoke({
-                "existing_treatments": existing_treatments_str,
-                "new_prescription": new_prescription_str,
-                "format_instructions": parser.get_format_instructions()
-            })
+    async def acompare_prescriptions(self, pairs: List[Tuple[PatientInsights, List[Treatment]]], max_concurrency: int = 8) -> List[PrescriptionComparison]:
+        """
+        Compare several (insights, new prescription) pairs concurrently, one request per pair.
+        :param pairs: Patient insights with the new prescription to compare against
+        :param max_concurrency: Maximum number of requests in flight
+        :return: One PrescriptionComparison per pair, in the same order as pairs
+        """
+        return await self._compare_chain.abatch(
+            [self._comparison_inputs(insights, new_prescription) for insights, new_prescription in pairs],
+            config={"max_concurrency": max_concurrency}
+        )
+
+    async def acompare_prescriptions_batched(self, pairs: List[Tuple[PatientInsights, List[Treatment]]], max_concurrency: int = 8) -> List[PrescriptionComparison]:
+        """
+        Compare many pairs, submitting those with the longest expected output first.
+        Pairs are sorted by their number of treatments (a proxy for output tokens) and sent through a single
+        abatch, whose sliding concurrency limit refills a freed slot as soon as any comparison completes.
+        :param pairs: Patient insights with the new prescription to compare against
+        :param max_concurrency: Maximum number of requests in flight
+        :return: One PrescriptionComparison per pair, in the same order as pairs
+        """
+        if not pairs:
+            return []
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0].traitements_habituels) + len(pairs[i][1]), reverse=True)
+        comparisons = await self.acompare_prescriptions([pairs[i] for i in order], max_concurrency=max_concurrency)
+
+        results: List[Optional[PrescriptionComparison]] = [None] * len(pairs)
+        for i, comparison in zip(order, comparisons):
+            results[i] = comparison
+        return results
 
 if __name__ == "__main__":
     # Example usage (will require OPENAI_API_KEY in environment)
@@ -12,7 +12,15 @@ Contract:
 
 import os
 import logging
-from typing import Optional, Dict
+import threading
+from typing import Optional, Dict, List
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError, NoCredentialsError
+    _HAS_BOTO3 = True
+except ImportError:
+    _HAS_BOTO3 = False
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -20,6 +28,14 @@ logger.setLevel(logging.INFO)
 
 # Global cache for resolved secrets
 _secrets_cache: Dict[str, str] = {}
+_secrets_lock = threading.Lock()
+
+# One lock per environment variable, so an SSM fetch only blocks callers of the same key
+_key_locks: Dict[str, threading.Lock] = {}
+
+# SSM client, created on first use and shared across calls and threads
+_ssm_client = None
+_ssm_client_lock = threading.Lock()
 
 
 class SecretResolutionError(Exception):
@@ -32,6 +48,22 @@ def _is_ssm_parameter_name(value: str) -> bool:
     return value.startswith("/")
 
 
+def _get_ssm_client():
+    """Return the shared SSM client, creating it on first use"""
+    global _ssm_client
+    if _ssm_client is None:
+        with _ssm_client_lock:
+            if _ssm_client is None:
+                _ssm_client = boto3.client('ssm')
+    return _ssm_client
+
+
+def _get_key_lock(env_var_name: str) -> threading.Lock:
+    """Return the lock serializing SSM resolution of one environment variable"""
+    with _secrets_lock:
+        return _key_locks.setdefault(env_var_name, threading.Lock())
+
+
 def _get_from_ssm(parameter_name: str) -> str:
     """
     Retrieve a secret from AWS Systems Manager Parameter Store
@@ -45,11 +77,14 @@ def _get_from_ssm(parameter_name: str) -> str:
     Raises:
         SecretResolutionError: If retrieval fails
     """
-    try:
-        import boto3
-        from botocore.exceptions import ClientError, NoCredentialsError
+    if not _HAS_BOTO3:
+        raise SecretResolutionError(
+            "boto3 is required to retrieve secrets from AWS SSM. "
+            "Install it with: pip install boto3"
+        )
 
-        ssm = boto3.client('ssm')
+    try:
+        ssm = _get_ssm_client()
 
         logger.info(f"Retrieving parameter from SSM (name hidden for security)")
 
@@ -60,11 +95,6 @@ def _get_from_ssm(parameter_name: str) -> str:
 
         return response['Parameter']['Value']
 
-    except ImportError:
-        raise SecretResolutionError(
-            "boto3 is required to retrieve secrets from AWS SSM. "
-            "Install it with: pip install boto3"
-        )
     except NoCredentialsError:
         raise SecretResolutionError(
             "AWS credentials not found. Ensure your Lambda has proper IAM permissions "
@@ -91,6 +121,54 @@ def _get_from_ssm(parameter_name: str) -> str:
         )
 
 
+def warm_cache(env_var_names: List[str]) -> None:
+    """
+    Pre-resolve several SSM-backed secrets with batched get_parameters calls
+
+    Intended for cold start: one SSM round-trip per 10 parameters instead of one
+    per secret. Best effort - anything not resolved here (unset variable, missing
+    parameter, AWS error) is left to get_secret, which reports it properly.
+
+    Args:
+        env_var_names: Names of the environment variables to resolve
+    """
+    # SSM parameter name -> environment variables pointing to it
+    pending: Dict[str, List[str]] = {}
+    for env_var_name in env_var_names:
+        if env_var_name in _secrets_cache:
+            continue
+        env_value = os.getenv(env_var_name)
+        if env_value is not None and _is_ssm_parameter_name(env_value):
+            pending.setdefault(env_value, []).append(env_var_name)
+
+    if not pending or not _HAS_BOTO3:
+        return
+
+    try:
+        ssm = _get_ssm_client()
+        parameter_names = list(pending)
+
+        # get_parameters accepts at most 10 names per call
+        for i in range(0, len(parameter_names), 10):
+            response = ssm.get_parameters(
+                Names=parameter_names[i:i + 10],
+                WithDecryption=True
+            )
+            with _secrets_lock:
+                for parameter in response.get('Parameters', []):
+                    for env_var_name in pending[parameter['Name']]:
+                        _secrets_cache[env_var_name] = parameter['Value']
+            if response.get('InvalidParameters'):
+                logger.warning(
+                    f"{len(response['InvalidParameters'])} SSM parameter(s) not found while warming the cache"
+                )
+    except Exception as e:
+        logger.warning(f"Failed to warm secrets cache from SSM: {e}")
+        return
+
+    logger.info("Secrets cache warmed from SSM")
+
+
 def get_secret(env_var_name: str, required: bool = True) -> Optional[str]:
     """
     Retrieve a secret from environment variable, automatically resolving SSM parameters
@@ -139,28 +217,35 @@ def get_secret(env_var_name: str, required: bool = True) -> Optional[str]:
 
     # Determine if it's an SSM parameter name or raw value
     if _is_ssm_parameter_name(env_value):
-        logger.info(f"Resolving {env_var_name} from SSM Parameter Store")
-        try:
-            secret_value = _get_from_ssm(env_value)
-            _secrets_cache[env_var_name] = secret_value
-            logger.info(f"Successfully resolved {env_var_name} from SSM")
-            return secret_value
-        except SecretResolutionError as e:
-            if required:
-                raise
-            logger.warning(f"Failed to resolve optional secret {env_var_name}: {e}")
-            return None
+        with _get_key_lock(env_var_name):
+            # Another thread may have resolved it while we were waiting for the lock
+            if env_var_name in _secrets_cache:
+                return _secrets_cache[env_var_name]
+
+            logger.info(f"Resolving {env_var_name} from SSM Parameter Store")
+            try:
+                secret_value = _get_from_ssm(env_value)
+                with _secrets_lock:
+                    _secrets_cache[env_var_name] = secret_value
+                logger.info(f"Successfully resolved {env_var_name} from SSM")
+                return secret_value
+            except SecretResolutionError as e:
+                if required:
+                    raise
+                logger.warning(f"Failed to resolve optional secret {env_var_name}: {e}")
+                return None
     else:
         # Raw value (local development)
         logger.debug(f"Using raw value for {env_var_name} (local development mode)")
-        _secrets_cache[env_var_name] = env_value
+        with _secrets_lock:
+            _secrets_cache[env_var_name] = env_value
         return env_value
 
 
 def clear_cache():
     """Clear the secrets cache. Useful for testing."""
-    global _secrets_cache
-    _secrets_cache = {}
+    with _secrets_lock:
+        _secrets_cache.clear()
     logger.debug("Secrets cache cleared")
 
 
@@ -5,75 +5,113 @@ These are mock tests that validate the data models and basic functionality
 without requiring actual LLM API calls.
 """
 
+import asyncio
+import threading
 import pytest
-from unittest.mock import MagicMock, patch
+from unittest.mock import Mock, patch
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.output_parsers import JsonOutputParser
+import insight_extractor
+import secrets_manager
 from insight_extractor import (
     InsightExtractor,
     PatientInsights,
+    PatientInsightsBatch,
     Treatment,
     PrescriptionComparison,
     ComparisonResult,
     Sexe
 )
+from highlighter import _compile_highlighter, highlight_text
 
+# Frozen fixture payloads
+_ANTECEDENTS = ("HTA", "Arthrose", "Chirurgie du genou")
+_RECOMMENDATIONS = ("Surveiller la tension artérielle avec le nouveau dosage de Zestryl",)
 
-@pytest.fixture
+# New prescription passed to the comparison tests (trusted literals, built once)
+_NEW_PRESCRIPTION = (
+    Treatment.model_construct(name="Zestryl", dosage="10 mg", frequency="1 le matin"),
+    Treatment.model_construct(name="Apixaban", dosage="5 mg", frequency="2 par jour")
+)
+
+
+@pytest.fixture(scope="session")
 def mock_patient_insights():
-    """Fixture providing sample patient insights data"""
-    return PatientInsights(
+    """Fixture providing sample patient insights data (trusted literals, built without validation)"""
+    return PatientInsights.model_construct(
         age=81,
         sexe=Sexe.FEMININ,
-        antecedents_medicaux=["HTA", "Arthrose", "Chirurgie du genou"],
+        # model_construct skips the list coercion, so convert the frozen payload explicitly
+        antecedents_medicaux=list(_ANTECEDENTS),
         traitements_habituels=[
-            Treatment(name="MACROGOL", dosage="4000 mg", frequency="1 le matin"),
-            Treatment(name="ZESTRYL", dosage="5 mg", frequency="1 le matin")
+            Treatment.model_construct(name="MACROGOL", dosage="4000 mg", frequency="1 le matin"),
+            Treatment.model_construct(name="ZESTRYL", dosage="5 mg", frequency="1 le matin")
         ],
         raison_hospitalisation="Lymphome cérébral primitif",
         traitement_sortie=[
-            Treatment(name="NATULAN", dosage="150 mg", frequency="J1 à J7"),
-            Treatment(name="ZESTRYL", dosage="5 mg", frequency="1 le matin")
+            Treatment.model_construct(name="NATULAN", dosage="150 mg", frequency="J1 à J7"),
+            Treatment.model_construct(name="ZESTRYL", dosage="5 mg", frequency="1 le matin")
         ],
         fonction_renale="Créatinine 75 µmol/L, DFG 72",
         fonction_hepatique="BHC Normal (ASAT/ALAT N)"
     )
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
+def mock_patient_insights_json(mock_patient_insights):
+    """Fixture providing the sample patient insights serialized once to UTF-8 JSON bytes"""
+    return mock_patient_insights.model_dump_json().encode("utf-8")
+
+
+@pytest.fixture(scope="session")
 def mock_prescription_comparison():
-    """Fixture providing sample prescription comparison data"""
-    return PrescriptionComparison(
+    """Fixture providing sample prescription comparison data (trusted literals, built without validation)"""
+    return PrescriptionComparison.model_construct(
         comparisons=[
-            ComparisonResult(
+            ComparisonResult.model_construct(
                 medication_name="Zestryl",
                 status="Changé",
                 details="Dosage augmenté de 5mg à 10mg"
             ),
-            ComparisonResult(
+            ComparisonResult.model_construct(
                 medication_name="Apixaban",
                 status="Nouveau",
                 details="Nouvel anticoagulant"
             )
         ],
-        recommendations=["Surveiller la tension artérielle avec le nouveau dosage de Zestryl"]
+        recommendations=list(_RECOMMENDATIONS)
     )
 
 
-def test_treatment_model():
+@pytest.fixture(scope="session")
+def extractor():
+    """Fixture providing one InsightExtractor shared by the whole session"""
+    return InsightExtractor(model_provider="openai", api_key="fake_key")
+
+
+def make_fake_extractor(response):
+    """Build an extractor whose LLM replays the given raw response"""
+    with patch.object(insight_extractor, "ChatOpenAI", return_value=FakeListChatModel(responses=[response])):
+        return InsightExtractor(model_provider="openai", api_key="fake_key")
+
+
+@pytest.mark.parametrize("name,dosage,frequency", [
+    ("DOLIPRANE", "1000 mg", "3 fois par jour"),
+    ("ASPIRIN", "100 mg", None),  # frequency is optional
+])
+def test_treatment_model(name, dosage, frequency):
     """Test Treatment data model"""
-    treatment = Treatment(
-        name="DOLIPRANE",
-        dosage="1000 mg",
-        frequency="3 fois par jour"
-    )
+    treatment = Treatment(name=name, dosage=dosage, frequency=frequency)
 
-    assert treatment.name == "DOLIPRANE"
-    assert treatment.dosage == "1000 mg"
-    assert treatment.frequency == "3 fois par jour"
+    assert treatment.name == name
+    assert treatment.dosage == dosage
+    assert treatment.frequency == frequency
 
 
 def test_patient_insights_model(mock_patient_insights):
     """Test PatientInsights data model"""
-    insights = mock_patient_insights
+    # Fixtures skip validation: run the fixture data through the full schema here
+    insights = PatientInsights.model_validate(mock_patient_insights.model_dump())
 
     assert insights.age == 81
     assert insights.sexe == Sexe.FEMININ
@@ -98,79 +136,239 @@ def test_prescription_comparison_model(mock_prescription_comparison):
     assert "Surveiller" in comparison.recommendations[0]
 
 
-@patch.dict('os.environ', {'OPENAI_API_KEY': 'fake-test-key'}, clear=False)
-def test_extractor_initialization():
+def test_extractor_initialization(extractor):
     """Test InsightExtractor initialization with mocked environment"""
-    extractor = InsightExtractor(model_provider="openai", api_key="fake_key")
-
     assert extractor is not None
     assert extractor.llm is not None
+    assert extractor._supports_structured
 
 
-def test_extraction_with_mock(mock_patient_insights):
+def test_extraction_with_mock(extractor, mock_patient_insights, monkeypatch):
     """Test extraction flow with mocked LLM response"""
-    with patch.dict('os.environ', {'OPENAI_API_KEY': 'fake-test-key'}, clear=False):
-        extractor = InsightExtractor(model_provider="openai", api_key="fake_key")
-        extractor.extract_from_text = MagicMock(return_value=mock_patient_insights)
+    # monkeypatch restores the shared extractor at teardown
+    monkeypatch.setattr(extractor, "extract_from_text", Mock(return_value=mock_patient_insights))
 
-        # Test extraction
-        insights = extractor.extract_from_text("Contenu de patient.txt")
+    # Test extraction
+    insights = extractor.extract_from_text("Contenu de patient.txt")
 
-        # Assertions
-        assert insights is not None
-        assert isinstance(insights, PatientInsights)
-        assert insights.age == 81
-        assert len(insights.traitements_habituels) == 2
+    # Assertions
+    assert insights is not None
+    assert type(insights) is PatientInsights
+    assert insights.age == 81
+    assert len(insights.traitements_habituels) == 2
 
-        # Verify the mock was called
-        extractor.extract_from_text.assert_called_once_with("Contenu de patient.txt")
+    # Verify the mock was called
+    extractor.extract_from_text.assert_called_once_with("Contenu de patient.txt")
 
 
-def test_comparison_with_mock(mock_patient_insights, mock_prescription_comparison):
+def test_comparison_with_mock(extractor, mock_patient_insights, mock_prescription_comparison, monkeypatch):
     """Test prescription comparison flow with mocked LLM response"""
-    with patch.dict('os.environ', {'OPENAI_API_KEY': 'fake-test-key'}, clear=False):
-        extractor = InsightExtractor(model_provider="openai", api_key="fake_key")
-        extractor.compare_prescription = MagicMock(return_value=mock_prescription_comparison)
+    # monkeypatch restores the shared extractor at teardown
+    monkeypatch.setattr(extractor, "compare_prescription", Mock(return_value=mock_prescription_comparison))
+
+    # Test comparison
+    comparison = extractor.compare_prescription(mock_patient_insights, _NEW_PRESCRIPTION)
 
-        # New prescription
-        new_prescription = [
-            Treatment(name="Zestryl", dosage="10 mg", frequency="1 le matin"),
-            Treatment(name="Apixaban", dosage="5 mg", frequency="2 par jour")
-        ]
+    # Assertions
+    assert comparison is not None
+    assert type(comparison) is PrescriptionComparison
+    assert len(comparison.comparisons) == 2
+    assert comparison.comparisons[0].medication_name == "Zestryl"
+    assert comparison.comparisons[0].status == "Changé"
+    assert len(comparison.recommendations) >= 1
 
-        # Test comparison
-        comparison = extractor.compare_prescription(mock_patient_insights, new_prescription)
+    # Verify the mock was called
+    extractor.compare_prescription.assert_called_once()
 
-        # Assertions
-        assert comparison is not None
-        assert isinstance(comparison, PrescriptionComparison)
-        assert len(comparison.comparisons) == 2
-        assert comparison.comparisons[0].medication_name == "Zestryl"
-        assert comparison.comparisons[0].status == "Changé"
-        assert len(comparison.recommendations) >= 1
 
-        # Verify the mock was called
-        extractor.compare_prescription.assert_called_once()
+def test_batch_extraction_with_fake_llm(mock_patient_insights):
+    """Test batch extraction parses one result per report, in order"""
+    second = mock_patient_insights.model_copy(update={"age": 65})
+    batch = PatientInsightsBatch(items=[mock_patient_insights, second])
+    extractor = make_fake_extractor(batch.model_dump_json())
 
+    results = extractor.extract_from_texts(["Compte-rendu 1", "Compte-rendu 2"])
 
-def test_json_serialization(mock_patient_insights):
-    """Test that models can be serialized to JSON"""
-    insights_json = mock_patient_insights.model_dump_json()
+    assert [r.age for r in results] == [81, 65]
+    assert results[0].traitements_habituels[0].name == "MACROGOL"
 
-    assert insights_json is not None
-    assert isinstance(insights_json, str)
-    assert "Lymphome cérébral primitif" in insights_json
-    assert "MACROGOL" in insights_json
+    # Mismatched item count must not be silently accepted
+    with pytest.raises(ValueError):
+        extractor.extract_from_texts(["Compte-rendu 1"])
 
 
-def test_treatment_without_frequency():
-    """Test Treatment model with optional frequency"""
-    treatment = Treatment(
-        name="ASPIRIN",
-        dosage="100 mg",
-        frequency=None
-    )
+def test_concurrent_comparison_with_fake_llm(mock_patient_insights, mock_prescription_comparison):
+    """Test concurrent comparisons return one result per pair, in order"""
+    extractor = make_fake_extractor(mock_prescription_comparison.model_dump_json())
+    new_prescription = [_NEW_PRESCRIPTION[0]]
+
+    comparisons = asyncio.run(extractor.acompare_prescriptions(
+        [(mock_patient_insights, new_prescription), (mock_patient_insights, new_prescription)]
+    ))
+
+    assert len(comparisons) == 2
+    assert all(c.comparisons[0].medication_name == "Zestryl" for c in comparisons)
+
+
+def test_batched_comparison_sorted_by_size(extractor, mock_patient_insights, monkeypatch):
+    """Test comparisons are submitted longest first in one batch and come back in input order"""
+    calls = []
+
+    async def fake_compare(pairs, max_concurrency=8):
+        calls.append(([len(new) for _, new in pairs], max_concurrency))
+        return [len(new) for _, new in pairs]
+
+    monkeypatch.setattr(extractor, "acompare_prescriptions", fake_compare)
+    pairs = [(mock_patient_insights, [_NEW_PRESCRIPTION[0]] * n) for n in (3, 0, 2, 1, 4)]
+
+    results = asyncio.run(extractor.acompare_prescriptions_batched(pairs, max_concurrency=5))
+
+    assert results == [3, 0, 2, 1, 4]
+    # A single batch keeps the whole concurrency budget
+    assert calls == [([4, 3, 2, 1, 0], 5)]
+    assert asyncio.run(extractor.acompare_prescriptions_batched([])) == []
+
+
+def test_streaming_extraction_with_fake_llm(mock_patient_insights):
+    """Test streamed extraction yields partial objects ending in valid insights"""
+    extractor = make_fake_extractor(mock_patient_insights.model_dump_json())
+
+    async def collect():
+        return [partial async for partial in extractor.astream_from_text("Contenu de patient.txt")]
+
+    partials = asyncio.run(collect())
+
+    assert len(partials) > 1
+    assert PatientInsights.model_validate(partials[-1]) == mock_patient_insights
+
+
+def test_structured_streaming_with_fake_llm(mock_patient_insights):
+    """Test streamed extraction goes through structured output with a JSON schema when supported"""
+    schemas = []
+
+    class StructuredFakeChatModel(FakeListChatModel):
+        def with_structured_output(self, schema, **kwargs):
+            schemas.append(schema)
+            return self | JsonOutputParser()
+
+    fake_llm = StructuredFakeChatModel(responses=[mock_patient_insights.model_dump_json()])
+    with patch.object(insight_extractor, "ChatOpenAI", return_value=fake_llm):
+        extractor = InsightExtractor(model_provider="openai", api_key="fake_key")
+
+    async def collect():
+        return [partial async for partial in extractor.astream_from_text("Contenu de patient.txt")]
+
+    partials = asyncio.run(collect())
+
+    assert extractor._supports_structured
+    assert PatientInsights.model_json_schema() in schemas
+    assert len(partials) > 1
+    assert PatientInsights.model_validate(partials[-1]) == mock_patient_insights
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("Patiente avec HTA.\nDFG < 60, sous MACROGOL. Lymphome.", ("HTA", "MACROGOL", "Lymphome")),
+    ("DFG < 60 et > 30, HTA", ("HTA",)),
+])
+def test_highlight_survives_angle_brackets(mock_patient_insights, text, expected):
+    """Test a bare < or > in the report does not swallow the terms after it"""
+    insights = mock_patient_insights.model_copy(update={"raison_hospitalisation": "Lymphome"})
+
+    html = highlight_text(text, insights)
+
+    for term in expected:
+        assert f"font-weight: bold;\">{term}</span>" in html
+    assert "DFG < 60" in html
+    assert "\n" not in html
+
+
+def test_highlight_long_term(mock_patient_insights):
+    """Test terms far longer than the recursion limit still compile and match, longest first"""
+    long_term = "HTA " + "x" * 5000
+    insights = mock_patient_insights.model_copy(update={"raison_hospitalisation": long_term})
+
+    assert _compile_highlighter((long_term, "HTA")).fullmatch(long_term.lower())
+    assert f">{long_term}</span>" in highlight_text(f"Motif : {long_term}", insights)
+
+
+def test_secret_fetch_only_blocks_same_key(monkeypatch):
+    """Test a slow SSM fetch for one key does not block resolving another key"""
+    fetching, release = threading.Event(), threading.Event()
+
+    def fake_get_from_ssm(parameter_name):
+        if parameter_name == "/app/slow":
+            fetching.set()
+            release.wait(timeout=5)
+        return f"value of {parameter_name}"
+
+    monkeypatch.setattr(secrets_manager, "_get_from_ssm", fake_get_from_ssm)
+    monkeypatch.setenv("SLOW_API_KEY", "/app/slow")
+    monkeypatch.setenv("FAST_API_KEY", "/app/fast")
+    secrets_manager.clear_cache()
+
+    results = {}
+    slow = threading.Thread(target=secrets_manager.get_secret, args=("SLOW_API_KEY",))
+    fast = threading.Thread(target=lambda: results.setdefault("fast", secrets_manager.get_secret("FAST_API_KEY")))
+    slow.start()
+    try:
+        assert fetching.wait(timeout=5)
+        fast.start()
+        fast.join(timeout=2)
+        # The fast key resolves while the slow fetch is still in flight
+        assert results == {"fast": "value of /app/fast"}
+    finally:
+        release.set()
+        slow.join()
+        fast.join()
+        secrets_manager.clear_cache()
+
+
+def test_warm_cache_batches_ssm_lookups(monkeypatch):
+    """Test warm_cache resolves SSM-backed secrets in chunks of 10 and skips what it cannot or need not fetch"""
+    calls = []
+
+    class FakeSSMClient:
+        def get_parameters(self, Names, WithDecryption):
+            calls.append(list(Names))
+            return {
+                "Parameters": [{"Name": n, "Value": f"value of {n}"} for n in Names if n != "/app/missing"],
+                "InvalidParameters": [n for n in Names if n == "/app/missing"]
+            }
+
+    monkeypatch.setattr(secrets_manager, "_HAS_BOTO3", True)
+    monkeypatch.setattr(secrets_manager, "_get_ssm_client", FakeSSMClient)
+    secrets_manager.clear_cache()
+
+    names = [f"KEY_{i}" for i in range(11)]
+    for i, name in enumerate(names):
+        monkeypatch.setenv(name, f"/app/key{i}")
+    monkeypatch.setenv("ALIAS_KEY", "/app/key0")  # shares a parameter with KEY_0
+    monkeypatch.setenv("MISSING_KEY", "/app/missing")
+    monkeypatch.setenv("RAW_KEY", "sk-raw")
+    monkeypatch.setenv("CACHED_KEY", "/app/cached")
+    monkeypatch.setitem(secrets_manager._secrets_cache, "CACHED_KEY", "cached value")
+
+    try:
+        secrets_manager.warm_cache(names + ["ALIAS_KEY", "MISSING_KEY", "RAW_KEY", "CACHED_KEY", "UNSET_KEY"])
+        cache = dict(secrets_manager._secrets_cache)
+    finally:
+        secrets_manager.clear_cache()
+
+    # 11 distinct parameters plus the missing one: one full chunk of 10, then the remaining 2
+    assert [len(chunk) for chunk in calls] == [10, 2]
+    assert sorted(n for chunk in calls for n in chunk) == sorted([f"/app/key{i}" for i in range(11)] + ["/app/missing"])
+    assert cache == {
+        **{name: f"value of /app/key{i}" for i, name in enumerate(names)},
+        "ALIAS_KEY": "value of /app/key0",
+        "CACHED_KEY": "cached value"
+    }
+
+
+def test_json_serialization(mock_patient_insights_json):
+    """Test that models can be serialized to JSON"""
+    blob = mock_patient_insights_json
 
-    assert treatment.name == "ASPIRIN"
-    assert treatment.dosage == "100 mg"
-    assert treatment.frequency is None
+    assert blob is not None
+    assert isinstance(blob, bytes)
+    assert "Lymphome cérébral primitif".encode("utf-8") in blob
+    assert b"MACROGOL" in blob